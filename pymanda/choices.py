@@ -2,6 +2,110 @@ import pymanda
 import pandas as pd
 import numpy as np
 import warnings
+import math
+
+
+def _prior_shares(groups, weights):
+    """
+    Cumulative share of each group's total weight that precedes each row.
+    
+    Rows of a group must be contiguous in groups. Shares are accumulated 
+    within each group so a group's result does not depend on the others.
+
+    """
+    if len(groups) == 0:
+        return np.empty(0)
+    
+    starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    lengths = np.diff(np.append(starts, len(groups)))
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    
+    totals = np.bincount(segment, weights=weights)
+    shares = pd.Series(weights / totals[segment])
+    cumulative = shares.groupby(segment, sort=False).cumsum().to_numpy()
+    
+    # shift by one row within each group
+    prior = np.empty(len(groups))
+    prior[1:] = cumulative[:-1]
+    prior[starts] = 0
+    
+    return prior
+
+
+def _hhi(codes, shares):
+    """
+    HHI of the groups identified by integer codes. Rows coded -1 or with a 
+    missing share are ignored.
+
+    """
+    valid = (codes != -1) & ~np.isnan(shares)
+    sums = np.bincount(codes[valid], weights=shares[valid])
+    
+    return np.dot(sums, sums) * 10000
+
+
+def _isin_lookup(uniques, values):
+    """
+    Lookup table over the codes pd.factorize returned with uniques marking 
+    which uniques are in values. The trailing False maps missing values, 
+    coded -1, to False.
+
+    """
+    return np.append(np.asarray(uniques.isin(values), dtype=bool), False)
+
+
+def _group_totals(df, group, weights):
+    """
+    Total weight of each combination of the group columns of df, sorted by
+    the group columns as groupby(group).sum() would be. Rows with a missing 
+    group value are ignored.
+
+    """
+    key = np.zeros(len(df), dtype=np.int64)
+    valid = np.ones(len(df), dtype=bool)
+    uniques = []
+    for col in group:
+        codes, col_uniques = pd.factorize(df[col], sort=True)
+        key = key * len(col_uniques) + codes
+        valid &= codes != -1
+        uniques.append(col_uniques)
+    
+    keys, inverse = np.unique(key[valid], return_inverse=True)
+    totals = np.bincount(inverse, weights=weights[valid], minlength=len(keys))
+    
+    positions = np.unravel_index(keys, [len(x) for x in uniques])
+    groups = pd.DataFrame({col: x.take(pos) for col, x, pos in zip(group, uniques, positions)})
+    
+    return groups, totals
+
+
+def _bin_keys(X, coef_order):
+    """
+    Integer keys identifying the bin of each row of X using the first 1, 2, 
+    ..., len(coef_order) columns of coef_order. Keys are factorized at every 
+    depth so they remain smaller than the number of rows.
+
+    """
+    keys = []
+    key = np.zeros(len(X), dtype=np.int64)
+    for coef in coef_order:
+        codes, uniques = pd.factorize(X[coef])
+        key = pd.factorize(key * (len(uniques) + 1) + codes + 1)[0]
+        keys.append(key)
+    
+    return keys
+
+
+def _bin_labels(X, cols, key):
+    """
+    Backspace-joined label of each distinct bin in key, built from the first 
+    row of the bin, and the position of every row's bin in those labels.
+
+    """
+    _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    labels = X[cols].iloc[first].astype(str).agg('\b'.join,axis=1).to_numpy()
+    
+    return labels, inverse
 
 
 """
@@ -68,7 +172,7 @@ class ChoiceData():
         self.geog_var = geog_var
         self.wght_var = wght_var
         
-        if type(data) !=  pd.core.frame.DataFrame:
+        if not isinstance(data, pd.core.frame.DataFrame):
             raise TypeError ('''Expected type pandas.core.frame.DataFrame Got {}'''.format(type(data)))
         
         if data.empty:
@@ -80,9 +184,104 @@ class ChoiceData():
                 raise KeyError ('''{} is not a column in Dataframe'''.format(param))
         
         for nonull in [choice_var, corp_var]:
-            if len(data[data['choice'] == ''].index) != 0:
+            if (data[nonull] == '').any():
                 raise ValueError ('''{} has missing values'''.format(nonull))
+    
+    @property
+    def data(self):
+        """
+        The customer level DataFrame. Assigning a new frame resets values 
+        cached from the old one, and cached codes of a column are rebuilt 
+        once the column is assigned new values.
+
+        """
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._clear_cache()
+    
+    def _clear_cache(self):
+        """
+        Utility function to reset values cached from self.data
+        
+        """
+        self._unique_cache = {}
+        self._codes_cache = {}
+    
+    def _column_values(self, column):
+        """
+        Utility function returning the array backing a column of self.data. 
+        Cached values are rebuilt when the array they came from is no longer 
+        the one backing the column.
+
+        """
+        return self._data[column]._values
      
+    def _restrict_cache(self, mask, data):
+        """
+        Utility function to replace self.data with data, the rows of self.data
+        kept by a boolean mask, carrying cached codes over to the kept rows. 
+        Codes are renumbered in order of appearance, matching pd.factorize on 
+        the restricted column.
+
+        """
+        codes_cache = {}
+        for column, (values, (codes, uniques)) in self._codes_cache.items():
+            if values is not self._column_values(column):
+                continue
+            codes = codes[mask]
+            valid = codes != -1
+            kept_codes, kept = pd.factorize(codes[valid])
+            codes[valid] = kept_codes
+            codes_cache[column] = (codes, uniques.take(kept))
+        
+        self.data = data
+        self._codes_cache = {column: (self._column_values(column), entry) for column, entry in codes_cache.items()}
+    
+    def _unique_values(self, column):
+        """
+        Utility function returning the set of unique values of a column in 
+        self.data. Sets are cached until the column is replaced or self.data
+        is restricted.
+
+        """
+        values = self._column_values(column)
+        if self._unique_cache.get(column, (None,))[0] is not values:
+            self._unique_cache[column] = (values, frozenset(pd.unique(self.data[column].values)))
+        
+        return self._unique_cache[column][1]
+    
+    def _factorize(self, column):
+        """
+        Utility function returning integer codes and unique values of a column
+        in self.data. Missing values are coded as -1. Results are cached until
+        the column is replaced or self.data is restricted.
+
+        """
+        values = self._column_values(column)
+        if self._codes_cache.get(column, (None,))[0] is not values:
+            self._codes_cache[column] = (values, pd.factorize(self.data[column]))
+        
+        return self._codes_cache[column][1]
+    
+    def _weights(self, weight_var, data=None):
+        """
+        Utility function returning the weight of each observation in data, 
+        self.data by default, as a float64 array. Missing weights are 
+        returned as 0. Every observation has a weight of 1 if weight_var is 
+        None.
+
+        """
+        if data is None:
+            data = self.data
+        
+        if weight_var is None:
+            return np.ones(len(data), dtype=np.int32)
+        
+        return data[weight_var].to_numpy(dtype=np.float64, na_value=0)
+    
     def corp_map(self):
         """
         Utility fuction to map corporation and choices in self.data
@@ -95,9 +294,16 @@ class ChoiceData():
         """
         if self.corp_var == self.choice_var:
             raise RuntimeError('''corp_map should only be called when self.corp_var is defined and different than self.choice_var''')
-        corp_map = self.data.groupby([self.corp_var, self.choice_var]).count()
-        corp_map = corp_map.reset_index()
-        corp_map = corp_map[[self.corp_var, self.choice_var]]
+        corp_codes, corp_uniques = self._factorize(self.corp_var)
+        choice_codes, choice_uniques = self._factorize(self.choice_var)
+        
+        n_choice = len(choice_uniques)
+        valid = (corp_codes != -1) & (choice_codes != -1)
+        pairs = np.unique(corp_codes[valid] * n_choice + choice_codes[valid])
+        
+        corp_map = pd.DataFrame({self.corp_var: corp_uniques.take(pairs // n_choice),
+                                 self.choice_var: choice_uniques.take(pairs % n_choice)})
+        corp_map = corp_map.sort_values([self.corp_var, self.choice_var]).reset_index(drop=True)
         
         return corp_map
     
@@ -144,49 +350,58 @@ class ChoiceData():
         if self.geog_var is None:
             raise KeyError ("geog_var is not defined")
         
-        if type(threshold) != list:
+        if not isinstance(threshold, list):
             threshold = [threshold]
         
-        if type(centers) != list:
+        if not isinstance(centers, list):
             centers = [centers]
         
+        corp_values = self._unique_values(self.corp_var)
         for center in centers:
-            if not self.data[self.corp_var].isin([center]).any():
+            if center not in corp_values:
                 raise ValueError ("{cen} is not in {corp}".format(cen=center, corp=self.corp_var))
         
         for alpha in threshold:
-            if type(alpha) != float:
+            if not isinstance(alpha, float):
                 raise TypeError ('''Expected threshold to be type float. Got {}'''.format(type(alpha)))
             if not 0 < alpha <= 1:
-                raise ValueError ('''Threshold value of {} is not between 0 and 1''').format(alpha)
+                raise ValueError ('''Threshold value of {} is not between 0 and 1'''.format(alpha))
         
-        df = self.data.copy(deep=True)
-        if self.wght_var is None:
-            df['count'] = 1
-            weight = 'count'
-        else:
-            weight = self.wght_var
-            
-        df = df[[self.corp_var, self.geog_var, weight]]
-     
-        df = df.groupby([self.corp_var, self.geog_var]).sum().reset_index() #calculate counts by geography
+        corp_codes, corp_uniques = self._factorize(self.corp_var)
+        geog_codes, geog_uniques = self._factorize(self.geog_var)
+        weights = self._weights(self.wght_var)
+        
+        # keep observations for centers with a non-missing geography
+        center_codes = corp_uniques.get_indexer(centers)
+        keep = np.isin(corp_codes, center_codes) & (geog_codes != -1)
+        
+        # calculate weights by corp and geography
+        n_geog = len(geog_uniques)
+        pair_codes, pairs = pd.factorize(corp_codes[keep] * n_geog + geog_codes[keep])
+        pair_weights = np.bincount(pair_codes, weights=weights[keep])
         
-        df['group_total'] = df[weight].groupby(df[self.corp_var]).transform('sum')  #get group totals
-        df['share'] = df[weight] / df['group_total'] # calculate share
-        df = df.groupby([self.corp_var, self.geog_var]).sum()
-        df = df.sort_values([self.corp_var, weight], ascending=False)
-        df_start = df.groupby(level=0).cumsum().reset_index() 
+        # sort by corp, then by descending weight and ascending geography
+        geog_rank = pd.factorize(geog_uniques, sort=True)[0]
+        order = np.lexsort((geog_rank[pairs % n_geog], -pair_weights, pairs // n_geog))
+        pair_weights = pair_weights[order]
+        pair_corps = pairs[order] // n_geog
+        pair_geogs = pairs[order] % n_geog
+        
+        # cumulative share of the corp preceding each geography
+        prior_shares = _prior_shares(pair_corps, pair_weights)
+        
+        # rows of each center in the sorted arrays
+        center_starts = np.searchsorted(pair_corps, center_codes, side='left')
+        center_ends = np.searchsorted(pair_corps, center_codes, side='right')
+        
+        # compare against every threshold at once
+        in_threshold = prior_shares[:, np.newaxis] < np.asarray(threshold)[np.newaxis, :]
         
         output_dict = {}
-        for alpha in threshold:
-            df = df_start
-            df['keep'] = np.where(df['share'].shift().fillna(1).replace(1, 0) < alpha, 1, 0)
-            
-            df = df[(df[self.corp_var].isin(centers)) & (df['keep']==1)]
-            
-            for center in centers:
-                in_psa = list(df[self.geog_var][df[self.corp_var]==center])
-                in_psa.sort()
+        for i, alpha in enumerate(threshold):
+            for center, start, end in zip(centers, center_starts, center_ends):
+                in_psa = pair_geogs[start:end][in_threshold[start:end, i]]
+                in_psa = sorted(geog_uniques.take(in_psa).tolist())
                 output_dict.update({"{cen}_{a}".format(cen=center, a=alpha) : in_psa})
                 
         return output_dict
@@ -196,7 +411,7 @@ class ChoiceData():
         Checks for custom restrictions
         """
         
-        if type(restriction) != pd.core.series.Series:
+        if not isinstance(restriction, pd.core.series.Series):
             raise TypeError ("Expected type pandas.core.series.Series. Got {}".format(type(restriction)))
         
         if restriction.dtype != np.dtype('bool'):
@@ -251,7 +466,11 @@ class ChoiceData():
 
         self.restriction_checks(restriction)
         
-        self.data = self.data[restriction]
+        # cached codes can be sliced when the restriction lines up row for row
+        if restriction.index.equals(self.data.index):
+            self._restrict_cache(restriction.to_numpy(), self.data[restriction])
+        else:
+            self.data = self.data[restriction]
         
     def calculate_shares(self, psa_dict=None, weight_var=None, restriction=None):
         """
@@ -298,7 +517,7 @@ class ChoiceData():
 
         """
 
-        if type(psa_dict) != dict and psa_dict is not None:
+        if not isinstance(psa_dict, dict) and psa_dict is not None:
             raise TypeError ("Expected type dict. Got {}".format(type(psa_dict)))
             
         if restriction is not None:
@@ -324,37 +543,50 @@ class ChoiceData():
         else:
             group = [self.corp_var, self.choice_var]
         
+        columns = group.copy()
+        if not base_shares and self.geog_var not in columns:
+            columns.append(self.geog_var)
+        
+        # only select the columns needed rather than copying all of self.data
+        if weight_var is not None:
+            columns.append(weight_var)
+        df_start = self.data[columns]
+            
+        if restriction is not None:
+            df_start = df_start[restriction]
+        
+        if not base_shares:
+            if restriction is None:
+                geog_values = self._unique_values(self.geog_var)
+                geog_codes, geog_uniques = self._factorize(self.geog_var)
+            else:
+                geog_values = frozenset(pd.unique(df_start[self.geog_var].values))
+                geog_codes, geog_uniques = pd.factorize(df_start[self.geog_var])
+        
+        weights_start = self._weights(weight_var, df_start)
+        
         output_dict = {}
         for key in psa_dict.keys():
-            df = self.data.copy(deep=True)
-            
-            redefine_weight=False
-            if weight_var is None:
-                df['count'] = 1
-                weight_var = 'count'
-                redefine_weight=True
-                
-            if restriction is not None:
-                df = df[restriction]
+            df = df_start
+            weights = weights_start
                 
             if not base_shares:
                 for geo in psa_dict[key]:
-                     if not df[self.geog_var].isin([geo]).any():
+                     if geo not in geog_values:
                          raise ValueError ("{g} is not in {col}".format(g=geo, col=self.geog_var)) 
-                df = df[df[self.geog_var].isin(psa_dict[key])]
-
-            df = df[group + [weight_var]]
-            df_shares = (df.groupby(group).sum() / df[weight_var].sum()).reset_index()
+                
+                keep = _isin_lookup(geog_uniques, psa_dict[key])[geog_codes]
+                df = df[keep]
+                weights = weights[keep]
             
-            df_shares = df_shares.rename(columns = {weight_var: 'share'})
+            df_shares, totals = _group_totals(df, group, weights)
+            df_shares['share'] = totals / weights.sum()
             output_dict.update({key: df_shares})
-            
-            if redefine_weight:
-                weight_var = None
 
         return output_dict
     
-    def shares_checks(self, df, share_col, data="Data"):
+    @staticmethod
+    def shares_checks(df, share_col, data="Data"):
         """
         Checks for columns that are supposed to contain shares
 
@@ -372,9 +604,10 @@ class ChoiceData():
         
         if share_col not in df.columns:
             raise KeyError("Column '{}' not in ChoiceData".format(share_col))
-        if (df[share_col] < 0).any():
+        shares = df[share_col].to_numpy(dtype=np.float64, na_value=np.nan)
+        if (shares < 0).any():
             raise ValueError ("Values of '{col}' in {d} contain negative values".format(col=share_col, d=data))
-        if df[share_col].sum() != 1:
+        if not math.isclose(np.nansum(shares), 1, rel_tol=1e-9):
             raise ValueError ("Values of '{col}' in {d} do not sum to 1".format(col=share_col, d=data))
     
     def calculate_hhi(self, shares_dict, share_col="share", group_col=None):
@@ -417,7 +650,7 @@ class ChoiceData():
         {'Base Shares': 3750.0}
 
         """
-        if type(shares_dict) != dict:
+        if not isinstance(shares_dict, dict):
             raise TypeError ("Expected type dict. Got {}".format(type(shares_dict)))
         
         if group_col is None:
@@ -428,13 +661,13 @@ class ChoiceData():
         for key in shares_dict.keys():
             df = shares_dict[key]
             
-            if type(df) != pd.core.frame.DataFrame:
+            if not isinstance(df, pd.core.frame.DataFrame):
                 raise TypeError ('''Expected type pandas.core.frame.DataFrame Got {}'''.format(type(df)))
             
             self.shares_checks(df, share_col, data=key)
             
-            df = df.groupby(group_col).sum()
-            hhi = (df[share_col] * df[share_col]).sum()*10000
+            codes = pd.factorize(df[group_col], sort=True)[0]
+            hhi = _hhi(codes, df[share_col].to_numpy(dtype=np.float64, na_value=np.nan))
             
             output_dict.update({key: hhi})
             
@@ -464,7 +697,7 @@ class ChoiceData():
             values will be a list of [pre-merge HHI, post-merge HHI, HHI change].
         """
         
-        if type(trans_list) != list:
+        if not isinstance(trans_list, list):
             raise TypeError ('''trans_list expected list. got {}'''.format(type(trans_list)))
         if len(trans_list) < 2:
             raise ValueError ('''trans_list needs atleast 2 elements to compare HHI change''')
@@ -472,24 +705,29 @@ class ChoiceData():
         if trans_var is None:
             trans_var = self.corp_var
 
+        trans_values = self._unique_values(trans_var)
         for elm in trans_list:
-            if not self.data[trans_var].isin([elm]).any():
+            if elm not in trans_values:
                 raise ValueError ('''{element} is not an element in column {col}'''.format(element=elm, col=trans_var))
         
-        output_dict = {}
         for key in shares.keys():
-            df = shares[key]
-            self.shares_checks(df, share_col, data=key)
+            self.shares_checks(shares[key], share_col, data=key)
             
-            if trans_var not in df.columns:
+            if trans_var not in shares[key].columns:
                 raise KeyError ('''{var} is not column name in {data}'''.format(var=trans_var, data=key))    
-            
-            pre_hhi = self.calculate_hhi({"x" : df}, share_col, group_col=trans_var)['x']
-            
-            post_df = df
-            post_df[trans_var] = post_df[trans_var].where(~post_df[trans_var].isin(trans_list), 'combined')
-            post_hhi = self.calculate_hhi({"x": post_df}, share_col, group_col=trans_var)['x']
-            
+        
+        output_dict = {}
+        for key in shares.keys():
+            df = shares[key]
+            codes, uniques = pd.factorize(df[trans_var], sort=True)
+            share_values = df[share_col].to_numpy(dtype=np.float64, na_value=np.nan)
+            pre_hhi = _hhi(codes, share_values)
+
+            # give all elements of trans_list the same code
+            combined = _isin_lookup(uniques, trans_list)[codes]
+            post_codes = np.where(combined, len(uniques), codes)
+            post_hhi = _hhi(post_codes, share_values)
+
             hhi_change = post_hhi - pre_hhi
             output_dict.update({key : [pre_hhi, post_hhi, hhi_change]})
             
@@ -589,8 +827,9 @@ class DiscreteChoice():
         # if type(cd) !=  pymanda.ChoiceData:
         #     raise TypeError ('''Expected type pymanda.choices.ChoiceData Got {}'''.format(type(cd)))
             
+        columns = set(cd.data.columns)
         for coef in self.coef_order:
-            if coef not in cd.data.columns:
+            if coef not in columns:
                 raise KeyError ('''{} is not a column in ChoiceData'''.format(coef))
                 
         if use_corp:
@@ -601,46 +840,44 @@ class DiscreteChoice():
         # currently only supports 'semiparametric' solver. Added solvers should use elif statement
         if self.solver=='semiparametric':
             
-            X = cd.data[self.coef_order + [choice]].copy()
+            X = cd.data[self.coef_order + [choice]]
+            weights = cd._weights(cd.wght_var)
             
-            if cd.wght_var is not None:
-                X['wght'] = cd.data[cd.wght_var]
-            else:
-                X['wght'] = 1
+            keys = _bin_keys(X, self.coef_order)
                 
             ## group observations
-            X['grouped'] = False
-            X['group'] = ""
-            for i in range(4, len(self.coef_order)+4):
-                bin_by_cols = X.columns[0:-i].to_list()
+            grouped = np.zeros(len(X), dtype=bool)
+            group = np.full(len(X), "ungrouped", dtype=object) # ungroupables keep "ungrouped"
+            for depth in range(len(self.coef_order), 0, -1):
+                bin_by_cols = self.coef_order[:depth]
                 if self.verbose:
                     print(bin_by_cols)
                 
-                screen = X[~X['grouped']].groupby(bin_by_cols).agg({'wght':['sum']})
-                    
-                screen = (screen >= self.min_bin)
-                screen.columns = screen.columns.droplevel(0)
+                # weight of ungrouped observations in each bin
+                key = keys[depth - 1]
+                bin_sums = np.bincount(key[~grouped], weights=weights[~grouped], minlength=key.max() + 1)
+                screen = ~grouped & (bin_sums[key] >= self.min_bin)
                 
-                X = pd.merge(X, screen, how='left', left_on=bin_by_cols,right_index=True)
-                X['sum'] = X['sum'].fillna(True)
-                # update grouped and group
-                X['group'] = np.where((~X['grouped']) & (X['sum']),
-                                      X[bin_by_cols].astype(str).agg('\b'.join,axis=1), X['group'])
-                X['grouped'] = X['grouped'] | X['sum']
-                X = X.drop('sum', axis=1) 
+                # label only the observations grouped at this depth
+                rows = np.flatnonzero(screen)
+                if len(rows) > 0:
+                    labels, inverse = _bin_labels(X.iloc[rows], bin_by_cols, key[rows])
+                    group[rows] = labels[inverse]
+                grouped = grouped | screen
                 
-            # group ungroupables
-            X.loc[X['group']=="",'group'] = "ungrouped"
-            
-            # converts from observations to group descriptions
-            X = X[[choice] + ['group', 'wght']].pivot_table(index='group', columns=choice, aggfunc='sum', fill_value=0)
+            # converts from observations to weighted counts of group by choice
+            # observations with a missing choice are dropped
+            choice_codes, choice_uniques = pd.factorize(X[choice], sort=True)
+            valid = choice_codes != -1
+            group_codes, group_uniques = pd.factorize(group[valid], sort=True)
+            n_choice = len(choice_uniques)
+            counts = np.bincount(group_codes * n_choice + choice_codes[valid], 
+                                 weights=weights[valid], minlength=len(group_uniques) * n_choice)
+            counts = counts.reshape(len(group_uniques), n_choice)
             
             #convert from counts to shares
-            X['rowsum'] = X.sum(axis=1)
-            for x in X.columns:
-                X[x] = X[x] / X['rowsum']
-            X = X.drop('rowsum', axis=1)
-            X.columns = [col[1] for col in X.columns]
+            X = pd.DataFrame(counts / counts.sum(axis=1, keepdims=True), 
+                             index=pd.Index(group_uniques, name='group'), columns=list(choice_uniques))
             X= X.reset_index()
             
             self.coef_ = X
@@ -670,19 +907,24 @@ class DiscreteChoice():
         if self.solver == 'semiparametric':
             
             #group based on groups
-            X = cd.data[self.coef_order].copy()
-            X['group'] = ""
-            for n in range(len(self.coef_order)):
-                X['g'] = X[self.coef_order[:len(self.coef_order) - n]].astype(str).agg('\b'.join,axis=1)
-                X['group'] = np.where((X['g'].isin(self.coef_['group'])) & (X['group'] == ""),
-                                      X['g'],
-                                      X['group'])
+            X = cd.data[self.coef_order]
+            keys = _bin_keys(X, self.coef_order)
+            groups = pd.Index(self.coef_['group'])
             
-            X.loc[X['group']=="",'group'] = "ungrouped"
-            X = X['group']
+            # position of each observation's group in self.coef_, deepest bin first
+            group_rows = np.full(len(X), -1)
+            for depth in range(len(self.coef_order), 0, -1):
+                labels, inverse = _bin_labels(X, self.coef_order[:depth], keys[depth - 1])
+                bin_rows = groups.get_indexer(labels)
+                group_rows = np.where(group_rows == -1, bin_rows[inverse], group_rows)
             
-            choice_probs = pd.merge(X, self.coef_, how='left', on='group')
-            choice_probs = choice_probs.drop(columns=['group'])            
+            group_rows[group_rows == -1] = groups.get_indexer(['ungrouped'])[0]
+            
+            # a trailing row of NaN for observations without a fitted group
+            probs = self.coef_.drop(columns=['group'])
+            values = np.vstack([probs.to_numpy(), np.full((1, probs.shape[1]), np.nan)])
+            
+            choice_probs = pd.DataFrame(values[group_rows], columns=probs.columns)
             
         
         return choice_probs
@@ -733,41 +975,39 @@ class DiscreteChoice():
         if len(choice_probs) != len(cd.data):
             raise ValueError('''length of choice_probs and cd.data should be the same''')
             
-        choice_probs['choice'] = cd.data[choice]
-        
-        all_choices = list(choice_probs['choice'].unique())
+        choice_codes, choice_uniques = cd._factorize(choice)
+        all_choices = list(choice_uniques)
             
         for c in all_choices:
             if c not in choice_probs.columns:
                 raise KeyError ('''{} is not a column in choice_probs'''.format(c))
         
-        if cd.wght_var is not None:
-            choice_probs['wght'] = cd.data[cd.wght_var]
-        else:
-            choice_probs['wght'] = 1
+        # pull probabilities and weights out of pandas once; rows are matched
+        # to cd.data by position and missing probabilities count as 0
+        probs = np.nan_to_num(choice_probs[all_choices].to_numpy(dtype=np.float64))
+        weights = cd._weights(cd.wght_var)
         
-        div_shares = pd.DataFrame(index=all_choices)
-        for diversion in div_choices:
+        # diverted choices keep NaN in their own column
+        out = np.full((len(all_choices), len(div_choices)), np.nan)
+        for j, diversion in enumerate(div_choices):
             if div_choices_var is None and cd.corp_var != cd.choice_var:
                 div_list = list(corp_map[corp_map[cd.corp_var].isin([diversion])][cd.choice_var])
             else:
                 div_list = [diversion]
                 
-            df = choice_probs[choice_probs['choice'].isin(div_list)].copy()
-            
-            all_choice_temp = all_choices.copy()
-            all_choice_temp = [x for x in all_choice_temp if x not in div_list]
+            diverted = _isin_lookup(choice_uniques, div_list)
+            rows = diverted[choice_codes]
+            keep = np.flatnonzero(~diverted[:-1])
             
-            df = df[all_choice_temp + ['wght']]
-            df['rowsum'] = df[all_choice_temp].sum(axis=1)
-            for x in all_choice_temp:
-                df[x] = df[x] / df['rowsum'] * df['wght']
-            df = df.drop(columns=['rowsum', 'wght'])
-            df = df.sum()
-            df = df / df.sum()
+            # rescale each row to its weight, skipping rows with no probability left
+            sub = probs[rows][:, keep]
+            rowsum = sub.sum(axis=1)
+            scale = np.divide(weights[rows], rowsum, out=np.zeros(len(rowsum)), where=rowsum > 0)
+            col_totals = scale @ sub
+            with np.errstate(invalid='ignore'):
+                out[keep, j] = col_totals / col_totals.sum()
 
-            df.name = diversion
-            div_shares = div_shares.merge(df, how='left', left_index=True, right_index=True)    
+        div_shares = pd.DataFrame(out, index=all_choices, columns=div_choices)
         
         return div_shares
     
@@ -804,27 +1044,24 @@ class DiscreteChoice():
             if tran not in choice_probs.columns:
                 raise KeyError ('''{} is not a choice in choice_probs'''.format(tran))
 
-        wtp_df = choice_probs[trans_list].copy()
-        
-        wtp_df['combined'] = wtp_df.sum(axis=1)
-        
+        # last column is the combined entity
+        probs = choice_probs[trans_list].to_numpy(dtype=np.float64)
+        probs = np.column_stack([probs, np.nansum(probs, axis=1)])
 
-        if (wtp_df==1).any().any():
+        if (probs == 1).any():
             warnings.warn('''A diversion probability for a bin equals 1 which will result in infinite WTP.''' , RuntimeWarning)
         
-        with warnings.catch_warnings(record = True): # prevents redundant warning for np.log(0)
-            wtp_df = -1 * np.log(1- wtp_df) # -1 * ln(1-prob)
+        with np.errstate(divide='ignore'): # prevents redundant warning for np.log(0)
+            wtp = -1 * np.log1p(-probs) # -1 * ln(1-prob)
         
         if cd.wght_var is not None:
-            cols = wtp_df.columns
-            wtp_df['wght'] = cd.data[cd.wght_var]
-            for c in cols:
-                wtp_df[c] = wtp_df[c] * wtp_df['wght']
-            wtp_df = wtp_df.drop(columns=['wght'])
+            wtp = wtp * cd._weights(cd.wght_var)[:, np.newaxis]
             
-        wtp_df = wtp_df.sum().to_frame().transpose()
+        wtp = np.nansum(wtp, axis=0)
         
-        wtp_df['wtp_change'] = (wtp_df['combined'] - wtp_df[trans_list].sum(axis = 1)) /  wtp_df[trans_list].sum(axis = 1)
+        wtp_df = pd.DataFrame([wtp], columns=trans_list + ['combined'])
+        with np.errstate(invalid='ignore'): # inf - inf when a probability is 1
+            wtp_df['wtp_change'] = (wtp[-1] - wtp[:-1].sum()) / wtp[:-1].sum()
     
         return wtp_df        
     
@@ -861,6 +1098,7 @@ class DiscreteChoice():
         
         expected_keys = ['name', 'price', 'margin']
         msg = '''upp_dict is expected to have only the following keys: {}'''.format(expected_keys)
+        corps = cd._unique_values(cd.corp_var)
         for d in [upp_dict1, upp_dict2]:
             if type(d) != dict:
                 raise TypeError('''upp_dict is expected to be type dict. Got {}'''.format(type(d)))
@@ -871,22 +1109,22 @@ class DiscreteChoice():
                 if key not in expected_keys:
                     raise KeyError(msg)
             
-                if d['name'] not in list(cd.data[cd.corp_var]):
-                    raise KeyError('''{name} is not a choice in ChoiceData column {col}'''.format(name=d['name'], col=cd.data[cd.corp_var]))
-                              
-                if type(d['price']) not in [int, float]:
-                    raise TypeError(''' 'price' is expected to be numeric. Got {}'''.format(type(d['price'])))
-                
-                if type(d['margin']) not in [int, float]:
-                    raise TypeError(''' 'margin' is expected to be numeric. Got {}'''.format(type(d['margin'])))
+            if d['name'] not in corps:
+                raise KeyError('''{name} is not a choice in ChoiceData column {col}'''.format(name=d['name'], col=cd.corp_var))
+                          
+            if type(d['price']) not in [int, float]:
+                raise TypeError(''' 'price' is expected to be numeric. Got {}'''.format(type(d['price'])))
+            
+            if type(d['margin']) not in [int, float]:
+                raise TypeError(''' 'margin' is expected to be numeric. Got {}'''.format(type(d['margin'])))
         
         if type(div_shares) != pd.core.frame.DataFrame:
             raise TypeError('''div_shares expected to be type pandas.core.frame.DataFrame. Got {}'''.format(type(div_shares)))
         
         if cd.corp_var != cd.choice_var:
             corp_map = cd.corp_map()
-            index_keep1 = list(corp_map[corp_map[cd.corp_var] == upp_dict1['name']]['choice'])
-            index_keep2 = list(corp_map[corp_map[cd.corp_var] == upp_dict2['name']]['choice'])
+            index_keep1 = list(corp_map[corp_map[cd.corp_var] == upp_dict1['name']][cd.choice_var])
+            index_keep2 = list(corp_map[corp_map[cd.corp_var] == upp_dict2['name']][cd.choice_var])
         else:
             index_keep1 = [upp_dict1['name']]
             index_keep2 = [upp_dict2['name']]
@@ -897,12 +1135,12 @@ class DiscreteChoice():
         upp1 = div1_to_2 * upp_dict2['margin'] * upp_dict2['price'] / upp_dict1['price']
         upp2 = div2_to_1 * upp_dict1['margin'] * upp_dict1['price'] / upp_dict2['price']        
         
-        if cd.wght_var is not None:
-            obs1 = cd.data[cd.wght_var][cd.data[cd.corp_var] == upp_dict1['name']].sum()
-            obs2 = cd.data[cd.wght_var][cd.data[cd.corp_var] == upp_dict2['name']].sum()
-        else:
-            obs1 = cd.data[cd.corp_var][cd.data[cd.corp_var] == upp_dict1['name']].count()
-            obs2 = cd.data[cd.corp_var][cd.data[cd.corp_var] == upp_dict2['name']].count()
+        # observations (or weights) of each corp from one pass over the data
+        corp_codes, corp_uniques = cd._factorize(cd.corp_var)
+        valid = corp_codes != -1
+        obs = np.bincount(corp_codes[valid], weights=cd._weights(cd.wght_var)[valid], minlength=len(corp_uniques))
+        obs1 = obs[corp_uniques.get_loc(upp_dict1['name'])]
+        obs2 = obs[corp_uniques.get_loc(upp_dict2['name'])]
             
         avg_upp = (upp1 * obs1  + upp2 * obs2) / (obs1 + obs2)
         
@@ -0,0 +1,65 @@
+import pytest
+from pymanda import ChoiceData
+import pandas as pd
+import numpy as np
+
+
+@pytest.fixture(scope="session")
+def psa_data():
+    '''create data for psa analysis'''
+    #create corporations series
+    corps = np.repeat(['x', 'y', 'z'], [50, 25, 25])
+    
+    #create choice series
+    # corp x: a, b; corp y: c, d; corp z: e
+    choices = np.repeat(['a', 'b', 'c', 'd', 'e'], [30, 20, 20, 5, 25])
+    
+    # create zips
+    # 75 psa, 90 psa and out of psa geographies listed in order for each corp
+    zips = np.repeat(np.array([1, 2, 3, 4, 5, 6, #corp x
+                               7, 8, 3, 5, #corp y
+                               7, 10, 3, 9, pd.NA], dtype=object), #corp z
+                     [20, 10, 8, 7, 3, 2,
+                      10, 9, 4, 2,
+                      10, 9, 4, 1, 1])
+    zips = pd.array(zips, dtype='Int16')
+    
+    psa_data = pd.DataFrame({'corporation': corps,
+                             'choice' : choices,
+                             "geography": zips})
+    
+    return psa_data
+
+@pytest.fixture(scope="session")
+def onechoice_data():
+    choices = np.repeat(['a'], 100)
+    
+    zips = np.repeat([1, 2, 3, 4, 5], 20)
+    
+    wght = np.repeat([1.5, 1, .75, .5, .25], 20)
+    
+    onechoice_data = pd.DataFrame({'choice': choices,
+                                   'geography': zips,
+                                   'weight' : wght})
+    return onechoice_data
+    
+@pytest.fixture(scope="session")
+def psa_data_cat(psa_data):
+    '''psa_data with categorical corporation and choice columns'''
+    psa_data_cat = psa_data.astype({'corporation': 'category', 'choice': 'category'})
+    
+    return psa_data_cat
+
+@pytest.fixture(scope="session")
+def psa_data_mixed(psa_data):
+    '''psa_data with an object geography column mixing ints and "" '''
+    zips = np.array([int(x) if x is not pd.NA else "" for x in psa_data['geography']], dtype=object)
+    psa_data_mixed = psa_data.assign(geography=zips)
+    
+    return psa_data_mixed
+
+@pytest.fixture
+def cd_psa(psa_data):
+    '''function scoped since tests restrict its data'''
+    cd_psa = ChoiceData(psa_data, "choice", corp_var='corporation', geog_var='geography')
+    return cd_psa
@@ -2,105 +2,46 @@ import pytest
 from pymanda import ChoiceData, DiscreteChoice
 import pandas as pd
 import numpy as np
+import tracemalloc
 
 
-@pytest.fixture
-def psa_data():
-    '''create data for psa analysis'''
-    #create corporations series
-    corps = ['x' for x in range(50)]
-    corps += ['y' for x in range(25)]
-    corps += ['z' for x in range(25)]
-    
-    #create choice series
-    #corp x
-    choices = ['a' for x in range(30)]
-    choices += ['b' for x in range(20)]
-    #corp y
-    choices += ['c' for x in range(20)]
-    choices += ['d' for x in range(5)]
-    #corp z
-    choices += ['e' for x in range(25)]
-    
-    # create zips
-    #corp x
-    zips = [1 for x in range(20)] #in 75 psa
-    zips += [2 for x in range(10)] #in 75 psa
-    zips += [3 for x in range(8)] #in 75 psa
-    zips += [4 for x in range(7)] #in 90 psa
-    zips += [5 for x in range(3)] # in 90 psa
-    zips += [6 for x in range(2)] # out of psa
-    #corp y
-    zips += [7 for x in range(10)] #in 75 psa
-    zips += [8 for x in range(9)] #in 75 psa
-    zips += [3 for x in range(4)] #in 90 psa
-    zips += [5 for x in range(2)] #out of psa
-    #corp z
-    zips += [7 for x in range(10)] #in 75 psa
-    zips += [10 for x in range(9)] #in 75 psa
-    zips += [3 for x in range(4)] #in 90 psa
-    zips += [9 for x in range(1)] #out of psa
-    zips += ["" for x in range(1)] #out of psa
-    
-    psa_data = pd.DataFrame({'corporation': corps,
-                             'choice' : choices,
-                             "geography": zips})
-    
-    return psa_data
-
-@pytest.fixture()
-def onechoice_data():
-    choices = ['a' for x in range(100)]
-    
-    zips = [1 for x in range(20)]
-    zips += [2 for x in range(20)]
-    zips += [3 for x in range(20)]
-    zips += [4 for x in range(20)]
-    zips += [5 for x in range(20)]
-    
-    wght = [1.5 for x in range(20)]
-    wght += [1 for x in range(20)]
-    wght += [.75 for x in range(20)]
-    wght += [.5 for x in range(20)]
-    wght += [.25 for x in range(20)]
-    
-    onechoice_data = pd.DataFrame({'choice': choices,
-                                   'geography': zips,
-                                   'weight' : wght})
-    return onechoice_data
-    
 ## Tests for ChoiceData Initialization
-def test_BadInput():
-    '''Test for error catching bad input'''
-    with pytest.raises(TypeError):
-        ChoiceData(["bad", "input"]) 
-
-def test_AllMissing():
-    '''test for empty dataframe'''
-    df_empty = pd.DataFrame({'corporation': [],
-                             'choice' : [],
-                             "geography": []})
-    with pytest.raises(ValueError):
-        ChoiceData(df_empty, 'choice', corp_var='corporation', geog_var='geography')
-
-def test_ChoiceMissing(psa_data):
-    '''test for an observation missing choice'''
-    df_miss = pd.DataFrame({'corporation': [""],
-                             'choice' : [""],
-                             "geography": [""]})
-    df_miss = pd.concat([df_miss, psa_data])
-    with pytest.raises(ValueError):
-        ChoiceData(df_miss, 'choice', corp_var='corporation', geog_var='geography')
-
-def test_BadCorp(psa_data):
-    '''test for corporation parameter not in data'''
-    with pytest.raises(KeyError):
-        ChoiceData(psa_data, 'choice', corp_var='corporations', geog_var='geography')
-
-def test_BadGeo(psa_data):
-    '''test for geog_var parameter not in data'''
-    with pytest.raises(KeyError):
-        ChoiceData(psa_data, 'choice', corp_var='corporation', geog_var='zips') 
+def _missing_choice(psa_data):
+    df_miss = pd.DataFrame({'corporation': np.array([""], dtype=object),
+                            'choice' : np.array([""], dtype=object),
+                            "geography": pd.array([pd.NA], dtype='Int16')})
+    return pd.concat([df_miss, psa_data])
+
+def _missing_corp(psa_data):
+    df_miss = pd.DataFrame({'corporation': pd.array([""], dtype=object),
+                            'choice' : pd.array(["a"], dtype=object),
+                            "geography": pd.array([1], dtype='Int16')})
+    return pd.concat([df_miss, psa_data])
+
+def _all_missing(psa_data):
+    return pd.DataFrame({'corporation': np.empty(0, dtype=object),
+                         'choice' : np.empty(0, dtype=object),
+                         "geography": pd.array([], dtype='Int16')})
+
+@pytest.mark.parametrize("make_data, params, error", [
+    # data is not a DataFrame
+    (lambda psa_data: ["bad", "input"], {}, TypeError),
+    # empty dataframe
+    (_all_missing, {'corp_var': 'corporation', 'geog_var': 'geography'}, ValueError),
+    # an observation missing choice
+    (_missing_choice, {'corp_var': 'corporation', 'geog_var': 'geography'}, ValueError),
+    # an observation missing corporation
+    (_missing_corp, {'corp_var': 'corporation', 'geog_var': 'geography'}, ValueError),
+    # corporation parameter not in data
+    (lambda psa_data: psa_data, {'corp_var': 'corporations', 'geog_var': 'geography'}, KeyError),
+    # geog_var parameter not in data
+    (lambda psa_data: psa_data, {'corp_var': 'corporation', 'geog_var': 'zips'}, KeyError)
+    ],
+    ids=['BadInput', 'AllMissing', 'ChoiceMissing', 'CorpMissing', 'BadCorp', 'BadGeo'])
+def test_ChoiceData_Validation(psa_data, make_data, params, error):
+    '''Test for error catching bad ChoiceData inputs'''
+    with pytest.raises(error):
+        ChoiceData(make_data(psa_data), 'choice', **params)
         
 def test_UndefinedCorp(psa_data):
     '''test for empty corporation parameter returning as choice_var'''
@@ -109,106 +50,216 @@ def test_UndefinedCorp(psa_data):
     
 
 ## Tests for estimate_psas()
-@pytest.fixture
-def cd_psa(psa_data):
-    cd_psa = ChoiceData(psa_data, "choice", corp_var='corporation', geog_var='geography')
-    return cd_psa
-
-def test_define_geogvar(psa_data):
-    '''Test for error raising if geography variable is not defined'''
-    bad_cd = ChoiceData(psa_data, "choice", corp_var='corporation')
-    with pytest.raises(KeyError):
-        bad_cd.estimate_psa(["x"])
+@pytest.mark.parametrize("params, centers, threshold, error", [
+    # geography variable is not defined
+    ({'corp_var': 'corporation'}, ['x'], None, KeyError),
+    # thresholds are not floats
+    ({'corp_var': 'corporation', 'geog_var': 'geography'}, ['x'], [.75, .9, 75], TypeError),
+    # a float threshold is not between 0 and 1
+    ({'corp_var': 'corporation', 'geog_var': 'geography'}, ['x'], [.75, 1.5], ValueError),
+    # psa centers are not in corp_var
+    ({'corp_var': 'corporation', 'geog_var': 'geography'}, ['a'], None, ValueError)
+    ],
+    ids=['define_geogvar', 'BadThreshold', 'ThresholdRange', 'BadCenters'])
+def test_EstimatePsa_Validation(psa_data, params, centers, threshold, error):
+    '''Test for error raising on bad estimate_psa inputs'''
+    cd = ChoiceData(psa_data, 'choice', **params)
+    kwargs = {} if threshold is None else {'threshold': threshold}
+    with pytest.raises(error):
+        cd.estimate_psa(centers, **kwargs)
+
+@pytest.mark.parametrize("data, params, centers, threshold, answer_dict", [
+    # 3 Corporations in the psa data with default parameters
+    ('psa_data', {'corp_var': 'corporation'}, ['x', 'y', 'z'], None,
+     {'x_0.75': [1,2,3],
+      'x_0.9': [1,2,3,4],
+      'y_0.75': [7,8],
+      'y_0.9': [3,7,8],
+      'z_0.75': [7,10],
+      'z_0.9' : [3,7,10]}),
+    # 1 Corporation in the psa data with default parameters
+    ('psa_data', {'corp_var': 'corporation'}, ['x'], None,
+     {'x_0.75': [1,2,3],
+      'x_0.9': [1,2,3,4]}),
+    # categorical corporation and choice columns give the same PSAs
+    ('psa_data_cat', {'corp_var': 'corporation'}, ['x', 'y', 'z'], None,
+     {'x_0.75': [1,2,3],
+      'x_0.9': [1,2,3,4],
+      'y_0.75': [7,8],
+      'y_0.9': [3,7,8],
+      'z_0.75': [7,10],
+      'z_0.9' : [3,7,10]}),
+    # object geography column mixing ints and ""
+    ('psa_data_mixed', {'corp_var': 'corporation'}, ['x', 'y', 'z'], None,
+     {'x_0.75': [1,2,3],
+      'x_0.9': [1,2,3,4],
+      'y_0.75': [7,8],
+      'y_0.9': [3,7,8],
+      'z_0.75': [7,10],
+      'z_0.9' : [3,7,10]}),
+    # 1 corporation with weight var and custom threshold
+    ('onechoice_data', {'wght_var': 'weight'}, ['a'], .6,
+     {'a_0.6': [1,2]}),
+    # multiple custom thresholds
+    ('onechoice_data', {'wght_var': 'weight'}, ['a'], [.6, .7],
+     {'a_0.6': [1,2],
+      'a_0.7': [1,2,3]}),
+    ], ids=['3Corp', '1corp', '3Corp_Categorical', '3Corp_MixedGeography', '1corp_weight', 'MultipleThresholds'])
+def test_EstimatePsa(request, data, params, centers, threshold, answer_dict):
+    '''Estimate PSAs for the test data sets'''
+    cd = ChoiceData(request.getfixturevalue(data), 'choice', geog_var='geography', **params)
+    
+    if threshold is None:
+        psa_dict = cd.estimate_psa(centers)
+    else:
+        psa_dict = cd.estimate_psa(centers, threshold=threshold)
+    
+    assert psa_dict == answer_dict
 
-def test_BadThreshold(cd_psa):
-    '''Test for error raising if thresholds are not between 0 and 1'''
-    with pytest.raises(TypeError):
-        cd_psa.estimate_psa(['x'], threshold=[.75, .9, 75])
+@pytest.mark.parametrize("zips", [
+    np.repeat([3, 1, 2], [25, 50, 25]),
+    np.repeat([2, 1, 3], [25, 50, 25]),
+    np.repeat([1, 2, 3], [50, 25, 25])
+    ], ids=['3First', '2First', 'Sorted'])
+def test_EstimatePsa_Ties(zips):
+    '''Geographies with tied weights at a threshold are kept in ascending order'''
+    tie_data = pd.DataFrame({'choice': np.repeat(['a'], 100),
+                             'geography': zips})
+    cd = ChoiceData(tie_data, 'choice', geog_var='geography')
+    
+    assert cd.estimate_psa(['a'], threshold=.6) == {'a_0.6': [1, 2]}
+
+def test_EstimatePsa_SkewedCenters():
+    '''One large center and many small centers are estimated in linear memory'''
+    n_big, n_small = 2000, 500
+    corps = np.concatenate([np.repeat(['big'], n_big),
+                            np.repeat(np.arange(n_small).astype(str), 15)])
+    zips = np.concatenate([np.arange(n_big),
+                           np.tile(np.repeat(np.arange(5), [5, 4, 3, 2, 1]), n_small)])
+    cd = ChoiceData(pd.DataFrame({'choice': corps, 'geography': zips}), 'choice', geog_var='geography')
+    centers = ['big'] + [str(x) for x in range(n_small)]
+    cd.estimate_psa(centers, threshold=.75)
+    
+    tracemalloc.start()
+    psa_dict = cd.estimate_psa(centers, threshold=.75)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    assert psa_dict['big_0.75'] == list(range(1500))
+    assert all(psa_dict['{}_0.75'.format(x)] == [0, 1, 2] for x in range(n_small))
+    # a padded centers x geographies matrix alone would take 8MB
+    assert peak < 4 * 10**6
+
+def test_EstimatePsa_FloatWeightCenters():
+    '''A center's PSA does not depend on the other centers requested'''
+    float_data = pd.DataFrame({'choice': ['A', 'B', 'B', 'B'],
+                               'geography': [1, 2, 3, 4],
+                               'weight': [6066751121.896031, 21.89301193269043,
+                                          32.83951789903565, 18.24417661057536]})
+    cd = ChoiceData(float_data, 'choice', geog_var='geography', wght_var='weight')
+    
+    alone = cd.estimate_psa(['B'], threshold=.75)
+    together = cd.estimate_psa(['A', 'B'], threshold=.75)
+    
+    assert alone == {'B_0.75': [2, 3]}
+    assert together['B_0.75'] == alone['B_0.75']
+
+def test_EstimatePsa_NullableWeight(onechoice_data):
+    '''Nullable integer weights with a missing weight give the same PSAs'''
+    weights = pd.array(np.repeat([6, 4, 3, 2, 1], 20), dtype='Int64')
+    weights[-1] = pd.NA
+    nullable_data = onechoice_data.assign(weight=weights)
+    cd = ChoiceData(nullable_data, 'choice', geog_var='geography', wght_var='weight')
+    
+    assert cd.estimate_psa(['a'], threshold=[.6, .7]) == {'a_0.6': [1,2], 'a_0.7': [1,2,3]}
+
+def test_EstimatePsa_NaNWeight():
+    '''Observations with a missing weight count as zero weight'''
+    nan_data = pd.DataFrame({'choice': ['a', 'a', 'a', 'a'],
+                             'geography': [1, 2, 3, 4],
+                             'weight': [5, 3, 1, np.NaN]})
+    cd = ChoiceData(nan_data, 'choice', geog_var='geography', wght_var='weight')
+    
+    assert cd.estimate_psa(['a']) == {'a_0.75': [1,2], 'a_0.9': [1,2,3]}
 
-def test_BadCenters(cd_psa):
-    '''Test for if psa centers are not in corp_var'''
-    with pytest.raises(ValueError):
-        cd_psa.estimate_psa(['a'])
+##Tests for restrict_data
+@pytest.fixture(scope="session")
+def corp_x_mask(psa_data):
+    '''rows of psa_data belonging to corporation x'''
+    corp_x_mask = psa_data['corporation']=='x'
+    return corp_x_mask
 
-def test_3Corp(cd_psa):
-    '''Estimate the 3 Corporations in the psa data with default parameters'''
-    psa_dict = cd_psa.estimate_psa(['x', 'y', 'z'])
+def test_RestrictData(psa_data, cd_psa, corp_x_mask):
+    '''Check if restrict data restricts data properly'''
+    cd_psa.restrict_data(corp_x_mask)
     
-    answer_dict = {'x_0.75': [1,2,3],
-                   'x_0.9': [1,2,3,4],
-                   'y_0.75': [7,8],
-                   'y_0.9': [3,7,8],
-                   'z_0.75': [7,10],
-                   'z_0.9' : [3,7,10]}
+    restricted_data = psa_data[corp_x_mask]
+    pd.testing.assert_frame_equal(cd_psa.data, restricted_data)
     
-    assert answer_dict==psa_dict
+def test_RestrictData_Centers(cd_psa, corp_x_mask):
+    '''Restricted out corporations should no longer be valid psa centers'''
+    cd_psa.estimate_psa(['y'])
+    cd_psa.restrict_data(corp_x_mask)
+    with pytest.raises(ValueError):
+        cd_psa.estimate_psa(['y'])
 
-def test_1corp(cd_psa):
-    '''Estimate the 1 Corporation in the psa data with default parameters'''
-    psa_dict = cd_psa.estimate_psa(['x'])
-    
-    answer_dict = {'x_0.75': [1,2,3],
-                   'x_0.9': [1,2,3,4]}
-    
-    assert answer_dict==psa_dict
-    
-def test_1corp_weight(onechoice_data):
-    ''' Estimate PSAs for 1 corporation with weight var and custom threshold'''
-    cd_onechoice = ChoiceData(onechoice_data, 'choice', geog_var='geography', wght_var='weight')
-    
-    psa_dict = cd_onechoice.estimate_psa(['a'], threshold=.6)
+def test_RestrictData_Cache(psa_data, cd_psa, corp_x_mask):
+    '''Codes cached before a restriction should match a fresh ChoiceData'''
+    cd_psa.estimate_psa(['x', 'y', 'z'])
+    cd_psa.restrict_data(~corp_x_mask)
     
-    answer_dict = {'a_0.6': [1,2]}
-    
-    assert psa_dict==answer_dict
-    
-def test_MultipleThresholds(onechoice_data):
-    ''' Estimate PSAs for multiple custom thresholds'''
-    cd_onechoice = ChoiceData(onechoice_data, 'choice', geog_var='geography', wght_var='weight')
-    
-    psa_dict = cd_onechoice.estimate_psa(['a'], threshold=[.6, .7])
-    
-    answer_dict = {'a_0.6': [1,2],
-                   'a_0.7': [1,2,3]}
-    
-    assert psa_dict == answer_dict
-
-##Tests for restrict_data
-def test_RestrictData(psa_data, cd_psa):
-    '''Check if restrict data restricts data properly'''
-    cd_psa.restrict_data(psa_data['corporation']=='x')
-    
-    restricted_data = psa_data[psa_data['corporation']=='x']
+    restricted_data = psa_data[~corp_x_mask]
     cd_restricted = ChoiceData(restricted_data, "choice", corp_var='corporation', geog_var='geography')
-    assert cd_restricted.data.equals(restricted_data)
+    assert cd_psa.estimate_psa(['y', 'z']) == cd_restricted.estimate_psa(['y', 'z'])
+    assert cd_psa.corp_map().equals(cd_restricted.corp_map())
+
+def test_RestrictData_Reassign(psa_data, cd_psa, corp_x_mask):
+    '''Reassigning data should reset codes cached from the old data'''
+    cd_psa.estimate_psa(['x', 'y', 'z'])
+    cd_psa.data = cd_psa.data[~corp_x_mask]
     
-def test_BadSeries(cd_psa, psa_data):
+    cd_restricted = ChoiceData(psa_data[~corp_x_mask], "choice", corp_var='corporation', geog_var='geography')
+    assert cd_psa.estimate_psa(['y', 'z']) == cd_restricted.estimate_psa(['y', 'z'])
+    with pytest.raises(ValueError):
+        cd_psa.estimate_psa(['x'])
+
+def test_RestrictData_AppendRows(psa_data):
+    '''Codes cached before rows are appended to data should be rebuilt'''
+    df = psa_data.copy()
+    cd = ChoiceData(df, "choice", corp_var='corporation', geog_var='geography')
+    cd.estimate_psa(['x'])
+    df.loc[len(df)] = ['w', 'f', 11]
+    
+    assert cd.estimate_psa(['w']) == {'w_0.75': [11], 'w_0.9': [11]}
+
+def test_RestrictData_AssignColumn():
+    '''Codes cached before a column is assigned new values should be rebuilt'''
+    df = pd.DataFrame({'choice': ['a'] * 10,
+                       'geography': [1] * 5 + [2] * 5})
+    cd = ChoiceData(df, "choice", geog_var='geography')
+    cd.estimate_psa(['a'])
+    cd.calculate_shares({'k': [1]})
+    cd.data['geography'] = [9] * 10
+    
+    assert cd.estimate_psa(['a']) == {'a_0.75': [9], 'a_0.9': [9]}
+    assert cd.calculate_shares({'k': [9]})['k']['share'].tolist() == [1.0]
+
+def test_BadSeries(cd_psa, corp_x_mask):
     '''Restrict_data should only accept boolean series'''
-    flag_series = np.where(psa_data['corporation']=='x', 1, 0)
+    flag_series = corp_x_mask.to_numpy().astype(np.int8)
     with pytest.raises(TypeError):
         cd_psa.restrict_data(flag_series)
 
 # Tests for calculate shares
-def dictionary_comparison(dict1, dict2):
-    if len(dict1.keys()) == 0 or len(dict2.keys()) == 0:
-        raise ValueError("Comparisons have 0 Keys")
-    
-    matches = []
-    if dict1.keys() == dict2.keys():
-        for key in dict1.keys():
-            matches.append(dict1[key].equals(dict2[key])) 
-    else:
-        raise ValueError("Comparison Keys do not match")
-    
-    return all(matches)
-
 def test_BaseShares(cd_psa):
     test_shares = cd_psa.calculate_shares()
     actual_shares = {'Base Shares': pd.DataFrame({'corporation':['x', 'x', 'y', 'y', 'z'],
                                                    'choice': ['a', 'b', 'c', 'd', 'e'],
                                                    'share': [.3, .2, .2, .05, .25]})}
     
-    assert dictionary_comparison(test_shares, actual_shares)
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
     
 def test_PsaShares(cd_psa):
     psa_test = {'x_0.75': [1,2,3]}
@@ -218,7 +269,9 @@ def test_PsaShares(cd_psa):
                                             'choice': ['a', 'b', 'c', 'd', 'e'],
                                             'share': [x / 46 for x in [30, 8, 1,3, 4]]})}
     
-    assert dictionary_comparison(test_shares, actual_shares)
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
     
 def test_MultiplePsaShares(cd_psa):
     psa_test = {'x_0.75': [1,2,3],
@@ -233,11 +286,74 @@ def test_MultiplePsaShares(cd_psa):
                                             'choice': ['a', 'b', 'c', 'd', 'e'],
                                             'share': [x / 53 for x in [30, 15, 1,3,4]]
                                             })}
-    assert dictionary_comparison(test_shares, actual_shares)
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
+
+def test_PsaShares_Restriction(cd_psa, psa_data):
+    psa_test = {'x_0.75': [1,2,3]}
+    test_shares = cd_psa.calculate_shares(psa_test, restriction=psa_data['corporation']!='z')
+    
+    actual_shares = {'x_0.75': pd.DataFrame({'corporation': ['x', 'x', 'y', 'y'],
+                                            'choice': ['a', 'b', 'c', 'd'],
+                                            'share': [x / 42 for x in [30, 8, 1,3]]})}
+    
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
+
+def test_PsaShares_Categorical(psa_data_cat):
+    cd_cat = ChoiceData(psa_data_cat, "choice", corp_var='corporation', geog_var='geography')
+    psa_test = {'x_0.75': [1,2,3]}
+    test_shares = cd_cat.calculate_shares(psa_test)
+    test_shares = {key: df.astype({'corporation': object, 'choice': object}) for key, df in test_shares.items()}
+    
+    actual_shares = {'x_0.75': pd.DataFrame({'corporation': ['x', 'x', 'y', 'y', 'z'],
+                                            'choice': ['a', 'b', 'c', 'd', 'e'],
+                                            'share': [x / 46 for x in [30, 8, 1,3, 4]]})}
+    
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
+
+def test_PsaShares_MixedGeography(psa_data_mixed):
+    cd_mixed = ChoiceData(psa_data_mixed, "choice", corp_var='corporation', geog_var='geography')
+    psa_test = {'x_0.75': [1,2,3]}
+    test_shares = cd_mixed.calculate_shares(psa_test)
+    
+    actual_shares = {'x_0.75': pd.DataFrame({'corporation': ['x', 'x', 'y', 'y', 'z'],
+                                            'choice': ['a', 'b', 'c', 'd', 'e'],
+                                            'share': [x / 46 for x in [30, 8, 1,3, 4]]})}
+    
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
+
+def test_BaseShares_NullableWeight(psa_data):
+    '''Missing nullable weights count as zero weight'''
+    df = psa_data.assign(weight=pd.array([pd.NA] + [1] * 99, dtype='Int64'))
+    cd = ChoiceData(df, "choice", corp_var='corporation', geog_var='geography', wght_var='weight')
+    test_shares = cd.calculate_shares()
+    
+    actual_shares = {'Base Shares': pd.DataFrame({'corporation':['x', 'x', 'y', 'y', 'z'],
+                                                   'choice': ['a', 'b', 'c', 'd', 'e'],
+                                                   'share': [x / 99 for x in [29, 20, 20, 5, 25]]})}
+    
+    assert test_shares.keys() == actual_shares.keys()
+    for key in actual_shares.keys():
+        pd.testing.assert_frame_equal(test_shares[key], actual_shares[key], check_exact=True)
+
+def test_PsaShares_BadGeo(cd_psa):
+    '''Geographies in psa_dict must be in geog_var'''
+    psa_test = {'x_0.75': [1,2,3],
+                'x_bad': [1,2,11]}
+    
+    with pytest.raises(ValueError):
+        cd_psa.calculate_shares(psa_test)
 
 
 #test for calculating HHI shares
-@pytest.fixture
+@pytest.fixture(scope="session")
 def base_shares():
     base_shares = pd.DataFrame({'corporation':['x', 'x', 'y', 'y', 'z'],
                                 'choice': ['a', 'b', 'c', 'd', 'e'],
@@ -246,10 +362,10 @@ def base_shares():
 
 @pytest.fixture
 def base_hhi():
-    base_hhi = [3750.0] 
+    base_hhi = 3750.0
     return base_hhi
     
-@pytest.fixture
+@pytest.fixture(scope="session")
 def psa_shares():
     psa_shares = pd.DataFrame({'corporation': ['x', 'x', 'y', 'y', 'z'],
                                 'choice': ['a', 'b', 'c', 'd', 'e'],
@@ -258,7 +374,8 @@ def psa_shares():
 
 @pytest.fixture
 def psa_hhi():
-    psa_hhi = 479347578744499 / 68719476736 # approximately 6975.43
+    # corporation shares of 38/46, 4/46 and 4/46
+    psa_hhi = sum((s * 100)**2 for s in [38/46, 4/46, 4/46]) # approximately 6975.43
     return psa_hhi
 
 def test_HHIs(cd_psa, base_shares, psa_shares, base_hhi, psa_hhi):
@@ -270,10 +387,10 @@ def test_HHIs(cd_psa, base_shares, psa_shares, base_hhi, psa_hhi):
     actual_hhis = {'Base Shares': base_hhi,
                   'x_0.75': psa_hhi} 
     
-    assert test_hhis == actual_hhis
+    assert test_hhis == pytest.approx(actual_hhis)
     
 def test_HHI_sharecol(cd_psa, base_shares, psa_shares, base_hhi):
-    df_alt = base_shares
+    df_alt = base_shares.copy()
     df_alt['other shares'] = df_alt['share']
     df_alt = df_alt.drop(columns="share")
     
@@ -286,7 +403,7 @@ def test_HHI_sharecol(cd_psa, base_shares, psa_shares, base_hhi):
     assert test_hhis == actual_hhis
     
 def test_HHI_BadSharecol(cd_psa, base_shares, psa_shares):
-    df_alt = psa_shares
+    df_alt = psa_shares.copy()
     df_alt['other shares'] = df_alt['share']
     df_alt = df_alt.drop(columns="share")
     
@@ -300,16 +417,73 @@ def test_HHI_BadInput(cd_psa):
     with pytest.raises(TypeError):
         cd_psa.calculate_hhi(cd_psa.data)
 
+def test_HHI_RoundedShares(cd_psa):
+    '''Shares that only sum to 1 up to floating point error are valid'''
+    df = pd.DataFrame({'corporation': ['x', 'y', 'z'],
+                       'share': [.7, .2, .1]})
+
+    test_hhis = cd_psa.calculate_hhi({'Base Shares': df})
+
+    assert test_hhis['Base Shares'] == pytest.approx(5400)
+
+def test_HHI_MissingShare(cd_psa):
+    '''Missing shares are skipped when summing shares'''
+    df = pd.DataFrame({'corporation': ['x', 'y', 'z'],
+                       'share': [.5, .5, np.NaN]})
+
+    test_hhis = cd_psa.calculate_hhi({'Base Shares': df})
+    test_change = cd_psa.hhi_change(['x', 'y'], {'Base Shares': df})
+
+    assert test_hhis['Base Shares'] == pytest.approx(5000)
+    assert test_change['Base Shares'] == pytest.approx([5000, 10000, 5000])
+
+@pytest.mark.parametrize("shares, hhi, change", [
+    (np.array([.5, .5, 0], dtype=object), 5000, [5000, 10000, 5000]),
+    (pd.array([1, 0, 0], dtype='Int64'), 10000, [10000, 10000, 0])
+    ], ids=['Object', 'Nullable'])
+def test_HHI_ShareDtypes(cd_psa, shares, hhi, change):
+    '''Object and nullable share columns are read as floats'''
+    df = pd.DataFrame({'corporation': ['x', 'y', 'z'],
+                       'share': shares})
+
+    test_hhis = cd_psa.calculate_hhi({'Base Shares': df})
+    test_change = cd_psa.hhi_change(['x', 'y'], {'Base Shares': df})
+
+    assert test_hhis['Base Shares'] == pytest.approx(hhi)
+    assert test_change['Base Shares'] == pytest.approx(change)
+
+def test_HHI_NullableMissingShare(cd_psa):
+    '''Missing nullable shares pass the share checks and are skipped'''
+    df = pd.DataFrame({'corporation': ['x', 'y', 'z'],
+                       'share': pd.array([1, 0, pd.NA], dtype='Int64')})
+
+    test_hhis = cd_psa.calculate_hhi({'Base Shares': df})
+
+    assert test_hhis['Base Shares'] == pytest.approx(10000)
+
 # test for calculating changes in HHI
 def test_HHIChange(cd_psa, base_shares, psa_shares, base_hhi, psa_hhi):
     share_dict = {'Base Shares': base_shares,
                   'x_0.75': psa_shares}
     test_change = cd_psa.hhi_change(['y', 'z'], share_dict)
     
+    # y and z combine into a corporation share of 8/46
+    psa_post_hhi = sum((s * 100)**2 for s in [38/46, 8/46]) # approximately 7126.65
     actual_change = {'Base Shares': [base_hhi, 5000, 1250],
-                     'x_0.75' : [psa_hhi, 7835839010804385 / 1099511627776, 166277750892401 / 1099511627776]} # approximately 7126.66 post and 151.23 change
+                     'x_0.75' : [psa_hhi, psa_post_hhi, psa_post_hhi - psa_hhi]} # approximately 151.23 change
+    
+    assert test_change.keys() == actual_change.keys()
+    for key in actual_change.keys():
+        assert test_change[key] == pytest.approx(actual_change[key])
+
+def test_HHIChange_NoMutation(cd_psa, base_shares):
+    '''hhi_change should not relabel the share tables it is given'''
+    share_dict = {'Base Shares': base_shares}
+    original = base_shares.copy()
+    
+    cd_psa.hhi_change(['y', 'z'], share_dict)
     
-    assert test_change == actual_change
+    assert share_dict['Base Shares'].equals(original)
 
 def test_HHIChange_TransCol(cd_psa, base_shares):
     share_dict = {"Base Shares": base_shares}
@@ -598,6 +772,42 @@ def test_DC_semiparm_diversion_wght(semi_dc, semi_cd_wght):
     
     assert test.round(decimals=4).equals(actual)
     
+@pytest.mark.skipif(not hasattr(pd, 'Float64Dtype'), reason="Float64 requires pandas 1.2")
+def test_DC_semiparm_diversion_NullableWeight(semi_dc, semi_cd_wght):
+    
+    df = semi_cd_wght.data.astype({'weight': 'Float64'})
+    nullable_cd = ChoiceData(df, 'choice', wght_var='weight')
+    
+    semi_dc.fit(nullable_cd)
+    
+    choice_probs = semi_dc.predict(nullable_cd)
+    test = semi_dc.diversion(nullable_cd, choice_probs, div_choices=['a', 'b', 'c'])
+    
+    actual = pd.DataFrame({'a': [np.NaN, .4143, .5857],
+                           'b': [.5291, np.NaN, .4709],
+                           'c': [.6905, .3095, np.NaN]},
+                          index = ['a', 'b', 'c'])
+    
+    assert test.round(decimals=4).equals(actual)
+
+def test_DC_semiparm_diversion_NaNWeight(semi_dc, semi_cd_wght):
+    
+    df = semi_cd_wght.data.copy()
+    df.loc[0, 'weight'] = np.NaN
+    nan_cd = ChoiceData(df, 'choice', wght_var='weight')
+    
+    df = df.fillna({'weight': 0})
+    zero_cd = ChoiceData(df, 'choice', wght_var='weight')
+    
+    semi_dc.fit(semi_cd_wght)
+    
+    choice_probs = semi_dc.predict(semi_cd_wght)
+    test = semi_dc.diversion(nan_cd, choice_probs, div_choices=['a', 'b', 'c'])
+    actual = semi_dc.diversion(zero_cd, choice_probs, div_choices=['a', 'b', 'c'])
+    
+    assert test.notna().sum().sum() == 6
+    assert test.equals(actual)
+    
 def test_DC_semiparm_diversion_2choice(semi_dc, semi_cd):
     
     semi_dc.fit(semi_cd)
@@ -611,6 +821,16 @@ def test_DC_semiparm_diversion_2choice(semi_dc, semi_cd):
     
     assert test.round(decimals=4).equals(actual)
 
+def test_DC_semiparm_diversion_NoMutation(semi_dc, semi_cd):
+    
+    semi_dc.fit(semi_cd)
+    
+    choice_probs = semi_dc.predict(semi_cd)
+    before = choice_probs.copy()
+    semi_dc.diversion(semi_cd, choice_probs, div_choices=['a'])
+    
+    assert choice_probs.equals(before)
+
 def test_DC_semiparam_fit_corp(semi_dc, semi_cd_corp):
     
     semi_dc.fit(semi_cd_corp)
@@ -756,3 +976,28 @@ def test_upp_corp(semi_cd_corp, semi_dc):
                           'avg_upp': .1490},
                           index = [0])
     assert test.round(decimals=4).equals(actual)
+
+def test_upp_corp_choicevar(semi_cd_corp, semi_dc):
+    df = semi_cd_corp.data.rename(columns={'choice': 'hospital'})
+    cd = ChoiceData(df, 'hospital', corp_var='corp')
+    
+    semi_dc.fit(cd)
+    choice_probs = semi_dc.predict(cd)
+    
+    div_shares = semi_dc.diversion(cd, choice_probs, div_choices=['a', 'b'])
+    
+    upp_dict1 = {'name': 'a',
+            'price' : 100,
+            'margin': .25}
+    
+    upp_dict2 = {'name': 'b',
+        'price' : 50,
+        'margin': .5}
+    
+    test = semi_dc.upp(cd, upp_dict1, upp_dict2, div_shares)
+    
+    actual = pd.DataFrame({'upp_a': .1036,
+                          'upp_b': .2646,
+                          'avg_upp': .1490},
+                          index = [0])
+    assert test.round(decimals=4).equals(actual)